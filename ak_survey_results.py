@@ -1,9 +1,18 @@
 import boto3
 import datetime
-from json import dumps
+import functools
+import math
+import re
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from json import dumps, loads
 
 import psycopg2
 import psycopg2.extras
+import psycopg2.pool
+from psycopg2.sql import SQL, Identifier
 from slugify.main import Slugify
 from pywell.entry_points import get_settings
 from pywell.secrets_manager import get_secret
@@ -19,9 +28,57 @@ ARG_DEFINITIONS = {
     'SINCE': 'Time to check since, for process_recent_actions_for_survey',
     'COLUMN_EXCLUDES': '(Optional) Comma-separated list of columns to exclude',
     'LAMBDA': ('(Optional) AWS Lambda function to process surveys. '
-               'If not supplied, surveys are processed synchronously.')
+               'If not supplied, surveys are processed synchronously.'),
+    'SURVEYS': ('JSON list of surveys (page_id and since) '
+                'for process_surveys_batch'),
+    'QUEUE': ('(Optional) AWS SQS queue URL to send surveys to for '
+              'processing. Takes precedence over LAMBDA.')
 }
 
+# Most messages SQS accepts in a single send_message_batch call.
+QUEUE_BATCH_SIZE = 10
+
+# Number of threads used to send asynchronous Lambda invocations.
+INVOKE_WORKERS = 64
+
+# Connections are pooled at module level so that warm Lambda invocations
+# reuse them instead of reconnecting.
+POOL_MAX_CONNECTIONS = 4
+_database_pool = None
+_database_pool_lock = threading.Lock()
+
+# COLUMN_EXCLUDES last loaded into each pooled connection's temporary
+# column_excludes table.
+loaded_column_excludes = weakref.WeakKeyDictionary()
+
+# Saved column lists by (survey schema, page ID), kept across warm Lambda
+# invocations as (expiry time, column list).
+COLUMN_LIST_TTL_SECONDS = 300
+column_list_cache = {}
+
+# Column names that get "_q" appended to avoid clashing with SQL keywords.
+RESERVED_KEYWORDS = frozenset([
+    'union', 'permissions', 'select', 'else', 'when', 'where', 'order',
+    'primary', 'identity', 'join'
+])
+
+# Field names that slugify would leave unchanged.
+CLEAN_FIELD_NAME = re.compile(r'[a-z0-9]+(_[a-z0-9]+)*')
+
+custom_slugify = Slugify(to_lower=True)
+custom_slugify.separator = '_'
+
+# Characters escaped in COPY text format.
+COPY_TEXT_ESCAPES = str.maketrans({
+    '\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'
+})
+
+# Rows per INSERT statement. PostgreSQL loads anything larger with COPY.
+INSERT_PAGE_SIZE = 1000
+
+# Rows fetched per round trip when streaming from a server-side cursor.
+FETCH_BATCH_SIZE = 2000
+
 settings = get_settings(ARG_DEFINITIONS, 'ak-survey-results')
 
 
@@ -41,26 +98,101 @@ class InvalidDbTypeException(Exception):
     '''Raise this when the specified database type is not handled'''
 
 
+@functools.lru_cache(maxsize=4096)
+def slugify_field_name(name):
+    """
+    Slugify a field name, skipping names that are already clean.
+    """
+    if CLEAN_FIELD_NAME.fullmatch(name):
+        return name
+    return custom_slugify(name)
+
+
+def database_pool():
+    """
+    Get the process-wide database connection pool, creating it on first use.
+    """
+    global _database_pool
+    with _database_pool_lock:
+        if _database_pool is None or _database_pool.closed:
+            db_settings = get_secret('redshift-admin')
+            _database_pool = psycopg2.pool.ThreadedConnectionPool(
+                minconn=1,
+                maxconn=POOL_MAX_CONNECTIONS,
+                host=db_settings['host'],
+                port=db_settings['port'],
+                user=db_settings['username'],
+                password=db_settings['password'],
+                database=db_settings['dbName']
+            )
+        return _database_pool
+
+
+def copy_text(value):
+    """
+    Format a value for COPY text format, with None as NULL.
+    """
+    if value is None:
+        return '\\N'
+    return str(value).translate(COPY_TEXT_ESCAPES)
+
+
+class CopyTextReader:
+    """
+    File-like object for copy_expert that renders rows as COPY text format
+    lines only as COPY reads them.
+    """
+
+    def __init__(self, rows):
+        self.lines = (
+            '\t'.join(copy_text(value) for value in row) + '\n'
+            for row in rows
+        )
+        self.pending = ''
+
+    def read(self, size=-1):
+        chunks = [self.pending]
+        length = len(self.pending)
+        while size < 0 or length < size:
+            line = next(self.lines, None)
+            if line is None:
+                break
+            chunks.append(line)
+            length += len(line)
+        text = ''.join(chunks)
+        if size < 0:
+            size = length
+        self.pending = text[size:]
+        return text[:size]
+
+
+def live_connection(pool):
+    """
+    Check a connection out of the pool, replacing it once if the server has
+    dropped it since it was last used.
+    """
+    connection = pool.getconn()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        pool.putconn(connection, close=True)
+        connection = pool.getconn()
+    return connection
+
+
 class AKSurveyResults:
 
     def __init__(self, settings):
         """
         Initialize settings.
         """
-        db_settings = get_secret('redshift-admin')
         self.settings = settings
-        self.database = psycopg2.connect(
-            host=db_settings['host'],
-            port=db_settings['port'],
-            user=db_settings['username'],
-            password=db_settings['password'],
-            database=db_settings['dbName']
-        )
+        self.database_pool = database_pool()
+        self.database = live_connection(self.database_pool)
         self.database_cursor = self.database.cursor(
             cursor_factory=psycopg2.extras.RealDictCursor
         )
-        self.custom_slugify = Slugify(to_lower=True)
-        self.custom_slugify.separator = '_'
         self.varchar_col_type = ''
         if self.settings.DB_TYPE.lower() == 'redshift':
             self.varchar_col_type = 'VARCHAR(MAX)'
@@ -69,29 +201,132 @@ class AKSurveyResults:
         else:
             raise InvalidDbTypeException('Database type %s not found.'
                                          % self.settings.DB_TYPE)
+        self.load_column_excludes()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        """
+        Return the database connection to the pool.
+        """
+        if getattr(self, 'database', None) is not None:
+            self.database_cursor.close()
+            self.database_pool.putconn(self.database)
+            self.database = None
+
+    def reset_connection(self):
+        """
+        Roll back the current transaction, replacing the connection if the
+        server has dropped it.
+        """
+        try:
+            self.database.rollback()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            self.database_cursor.close()
+            self.database_pool.putconn(self.database, close=True)
+            self.database = live_connection(self.database_pool)
+            self.database_cursor = self.database.cursor(
+                cursor_factory=psycopg2.extras.RealDictCursor
+            )
+            self.load_column_excludes()
+
+    def load_column_excludes(self):
+        """
+        Load COLUMN_EXCLUDES into a temporary table on this connection, so
+        field names can be excluded with an anti-join. The table lasts as
+        long as the pooled connection, so it is only reloaded when the
+        excludes change.
+        """
+        excludes = tuple(sorted(set(
+            name
+            for name in (self.settings.COLUMN_EXCLUDES or '').split(',')
+            if name
+        )))
+        if loaded_column_excludes.get(self.database) == excludes:
+            return
+        load_query = SQL("""
+        CREATE TEMPORARY TABLE IF NOT EXISTS column_excludes (
+            name VARCHAR(765) PRIMARY KEY
+        );
+        DELETE FROM column_excludes
+        """)
+        if excludes:
+            load_query += SQL(""";
+            INSERT INTO column_excludes (name) VALUES {}
+            """).format(SQL(', ').join([SQL('(%s)')] * len(excludes)))
+        self.database_cursor.execute(load_query, excludes)
+        self.database.commit()
+        loaded_column_excludes[self.database] = excludes
+
+    def ak_table(self, table):
+        """
+        Qualified identifier for an ActionKit table.
+        """
+        return Identifier(self.settings.DB_SCHEMA_AK, table)
+
+    def survey_table(self, table):
+        """
+        Qualified identifier for a survey results table.
+        """
+        return Identifier(self.settings.DB_SCHEMA_SURVEY, table)
+
+    def page_table(self, page_id):
+        """
+        Qualified identifier for the results table of a survey page.
+        """
+        return self.survey_table('page_%d' % int(page_id))
 
     def survey_refresh_info(self, page_id):
         """
         Check refresh info for a given survey page ID.
         """
-        survey_info_query = """
+        try:
+            return self.survey_info(page_id, include_saved_count=True)
+        except psycopg2.errors.UndefinedTable as e:
+            self.database.rollback()
+            # Re-check without the saved count to raise the right exception.
+            self.survey_info(page_id)
+            raise PageNotLoadedException(
+                'Results table for survey %d does not exist.' % int(page_id)
+            ) from e
+
+    def survey_info(self, page_id, include_saved_count=False):
+        """
+        Get type, pages record and action count for a given survey page ID,
+        optionally with the count of saved results in the same query.
+        """
+        saved_count_column = SQL('')
+        if include_saved_count:
+            saved_count_column = SQL(""",
+               (SELECT COUNT(pa.action_id)
+                FROM {} pa) AS saved_count""").format(
+                self.page_table(page_id)
+            )
+        survey_info_query = SQL("""
         SELECT p.type,
                sr.page_id,
                sr.column_list,
                sr.last_refresh,
-               COUNT(a.id) AS action_count
-        FROM %s.core_page p
-        LEFT JOIN %s.pages sr ON sr.page_id = p.id
-        LEFT JOIN %s.core_action a ON a.page_id = p.id
-        WHERE p.id = %d
+               COUNT(a.id) AS action_count{}
+        FROM {} p
+        LEFT JOIN {} sr ON sr.page_id = p.id
+        LEFT JOIN {} a ON a.page_id = p.id
+        WHERE p.id = %s
         GROUP BY 1,2,3,4
-        """ % (
-            self.settings.DB_SCHEMA_AK,
-            self.settings.DB_SCHEMA_SURVEY,
-            self.settings.DB_SCHEMA_AK,
-            int(page_id)
+        """).format(
+            saved_count_column,
+            self.ak_table('core_page'),
+            self.survey_table('pages'),
+            self.ak_table('core_action')
         )
-        self.database_cursor.execute(survey_info_query)
+        self.database_cursor.execute(survey_info_query, (int(page_id),))
         survey_info_result = list(self.database_cursor.fetchall())
         if len(survey_info_result) == 0:
             raise PageNotFoundException('Page %d not found.' % int(page_id))
@@ -105,129 +340,175 @@ class AKSurveyResults:
                 'Results for survey %d have not yet been loaded.'
                 % int(page_id)
             )
-        saved_count_query = """
-        SELECT COUNT(pa.action_id) AS saved_count
-        FROM %s.page_%d pa
-        """ % (
-            self.settings.DB_SCHEMA_SURVEY,
-            int(page_id)
-        )
-        try:
-            self.database_cursor.execute(saved_count_query)
-        except psycopg2.errors.UndefinedTable as e:
-            self.database.rollback()
-            raise PageNotLoadedException from e
-        saved_count_result = list(self.database_cursor.fetchall())
-        result['saved_count'] = saved_count_result[0].get('saved_count', 0)
         return result
 
     def recent_actions_for_survey(self, page_id, since='1900-01-01 00:00:00'):
         """
         Get all actions for a given page ID (page_id) since the given
-        time (since).
+        time (since), as (id, created_at) tuples.
         """
-        actions_query = """
+        actions_query = SQL("""
         SELECT a.id, a.created_at
-        FROM %s.core_action a
-        WHERE a.page_id = %d
-        AND a.created_at >= '%s'
+        FROM {} a
+        WHERE a.page_id = %s
+        AND a.created_at >= %s
         ORDER BY a.created_at ASC
         LIMIT 10000
-        """ % (
-            self.settings.DB_SCHEMA_AK,
-            int(page_id),
-            since
+        """).format(self.ak_table('core_action'))
+        with self.database.cursor() as cursor:
+            cursor.execute(actions_query, (int(page_id), since))
+            return cursor.fetchall()
+
+    def recent_actions_for_surveys(self, surveys):
+        """
+        Get actions for several surveys (page_id and since) in one query,
+        as a dict of page ID to the survey's (id, created_at) actions, up to
+        10000 each.
+        """
+        if not surveys:
+            return {}
+        surveys_query = SQL(' UNION ALL ').join(
+            [SQL(
+                'SELECT CAST(%s AS INTEGER) AS page_id, '
+                'CAST(%s AS TIMESTAMP) AS since'
+            )] * len(surveys)
         )
-        self.database_cursor.execute(actions_query)
-        return list(self.database_cursor.fetchall())
+        params = []
+        for survey in surveys:
+            params += [int(survey.get('page_id')), survey.get('since')]
+        if self.settings.DB_TYPE.lower() == 'redshift':
+            # Redshift has no LATERAL, so rank each survey's actions instead.
+            actions_query = SQL("""
+            SELECT ranked.page_id, ranked.id, ranked.created_at
+            FROM (
+                SELECT a.page_id, a.id, a.created_at,
+                       ROW_NUMBER() OVER (
+                           PARTITION BY a.page_id ORDER BY a.created_at ASC
+                       ) AS action_number
+                FROM {} a
+                JOIN ({}) s ON s.page_id = a.page_id
+                WHERE a.created_at >= s.since
+            ) ranked
+            WHERE ranked.action_number <= 10000
+            ORDER BY ranked.page_id, ranked.created_at ASC
+            """).format(self.ak_table('core_action'), surveys_query)
+        else:
+            # LIMIT inside LATERAL stops each survey's scan at 10000 actions.
+            actions_query = SQL("""
+            SELECT s.page_id, a.id, a.created_at
+            FROM ({}) s
+            CROSS JOIN LATERAL (
+                SELECT a.id, a.created_at
+                FROM {} a
+                WHERE a.page_id = s.page_id
+                AND a.created_at >= s.since
+                ORDER BY a.created_at ASC
+                LIMIT 10000
+            ) a
+            ORDER BY s.page_id, a.created_at ASC
+            """).format(surveys_query, self.ak_table('core_action'))
+        with self.database.cursor() as cursor:
+            cursor.execute(actions_query, params)
+            rows = cursor.fetchall()
+        by_page = {}
+        for page_id, action_id, created_at in rows:
+            by_page.setdefault(page_id, []).append((action_id, created_at))
+        return by_page
 
     def max_created_at(self, actions):
-        max_created_at = datetime.datetime(1900, 1, 1, 0, 0)
-        for action in actions:
-            created_at = action.get(
-                'created_at',
-                datetime.datetime(1900, 1, 1, 0, 0)
-            )
-            if created_at > max_created_at:
-                max_created_at = created_at
-        return max_created_at
+        """
+        Latest created_at of actions, which are ordered by created_at.
+        """
+        if not actions:
+            return datetime.datetime(1900, 1, 1, 0, 0)
+        return actions[-1][1]
 
     def field_values_for_actions(self, action_ids):
         """
-        Get all field values for given list of action IDs.
-        """
-        excludes = self.settings.COLUMN_EXCLUDES.split(',')
-        values_query = """
-        SELECT af.parent_id AS action_id, af.name, af.value
-        FROM %s.core_actionfield af
-        WHERE af.parent_id IN (%s)
-        AND NOT af.name = ANY(%s)
-        """ % (
-            self.settings.DB_SCHEMA_AK,
-            ', '.join([str(id) for id in action_ids]),
-            '%s'
+        Stream all field values for given list of action IDs as
+        (action_id, name, value) tuples, with repeated fields of the same
+        action joined by "; ".
+        """
+        if self.settings.DB_TYPE.lower() == 'redshift':
+            aggregate = SQL(
+                "LISTAGG(af.value, '; ') WITHIN GROUP (ORDER BY af.id)"
+            )
+        else:
+            aggregate = SQL("STRING_AGG(af.value, '; ' ORDER BY af.id)")
+        values_query = SQL("""
+        SELECT af.parent_id AS action_id, af.name, {} AS value
+        FROM {} af
+        WHERE af.parent_id = ANY(%s)
+        AND NOT EXISTS (
+            SELECT 1 FROM column_excludes e WHERE e.name = af.name
         )
-        self.database_cursor.execute(values_query, (excludes, ))
-        return list(self.database_cursor.fetchall())
+        GROUP BY af.parent_id, af.name
+        """).format(aggregate, self.ak_table('core_actionfield'))
+        # A named cursor keeps the result set on the server and fetches it
+        # in batches of itersize rows as it is iterated.
+        with self.database.cursor(name='field_values') as cursor:
+            cursor.itersize = FETCH_BATCH_SIZE
+            cursor.execute(values_query, (list(action_ids),))
+            yield from cursor
 
-    def field_values_by_action(self, field_values, name_map, action_ids):
-        by_action = {}
-        for action_id in action_ids:
-            if not by_action.get(action_id, False):
-                by_action[action_id] = {}
-        for field_value in field_values:
-            action_id = field_value.get('action_id', 0)
-            name = field_value.get('name', '')
-            value = field_value.get('value', '')
-            if not by_action.get(action_id, False):
-                by_action[action_id] = {}
-            if not by_action[action_id].get(name_map.get(name, ''), False):
-                by_action[action_id][name_map.get(name, '')] = value
-            else:
-                by_action[action_id][name_map.get(name, '')] += '; %s' % value
+    def field_values_by_action(self, field_values, action_ids):
+        """
+        Collect field values into a dict of field name to value per action.
+        """
+        by_action = {action_id: {} for action_id in action_ids}
+        # Bound once, as this loop runs for every field value row.
+        setdefault = by_action.setdefault
+        for action_id, name, value in field_values:
+            setdefault(action_id, {})[name] = value
         return by_action
 
     def deduped_columns(self, columns):
         deduped_columns = []
-        reserved_keywords = [
-            'union', 'permissions', 'select', 'else', 'when', 'where', 'order',
-            'primary', 'identity', 'join'
-        ]
+        seen_counts = {}
+        used_columns = set()
         for column in columns:
             column_name = column
             # Replace emtpy column name with "unnamed_field"
             if column_name == '':
                 column_name = 'unnamed_field'
             # Append _q to reserved keywords
-            if column_name in reserved_keywords:
+            if column_name in RESERVED_KEYWORDS:
                 column_name = column_name + '_q'
             # Prepend q_ to things that start with numbers
             if column_name[0].isdigit():
                 column_name = 'q_' + column_name
-            # Append count to duplicates
-            count = deduped_columns.count(column_name)
+            # Append count to duplicates, skipping names already used
+            count = seen_counts.get(column_name, 0)
+            deduped_column = column_name
             if count > 0:
-                deduped_columns.append(column_name + str(count + 1))
-            else:
-                deduped_columns.append(column_name)
+                deduped_column = column_name + str(count + 1)
+            while deduped_column in used_columns:
+                count += 1
+                deduped_column = column_name + str(count + 1)
+            seen_counts[column_name] = count + 1
+            used_columns.add(deduped_column)
+            deduped_columns.append(deduped_column)
         return deduped_columns
 
-    def unique_field_names(self, field_values):
+    def field_names_and_slugs(self, by_action):
         """
-        Reduce a list of core_actionfield records to unique field names.
+        Reduce field values by action to sorted unique field names, their
+        column slugs, and a map from name to slug.
         """
-        field_names = list(set([
-            row.get('name') for row in field_values if row.get('name', False)
-        ]))
-        field_names.sort()
-        return field_names
+        names = set()
+        add_names = names.update
+        for values in by_action.values():
+            add_names(values)
+        field_names = sorted(name for name in names if name)
+        field_slugs = self.sluggified_field_names(field_names)
+        return field_names, field_slugs, dict(zip(field_names, field_slugs))
 
     def sluggified_field_names(self, field_value_names):
         """
         Sluggify a list of field names.
         """
         return self.deduped_columns(
-            [self.custom_slugify(name) for name in field_value_names]
+            [slugify_field_name(name) for name in field_value_names]
         )
 
     def survey_table_needs_recreating(self, page_id, column_list):
@@ -235,30 +516,78 @@ class AKSurveyResults:
         Determine whether a table structure should be recreated, if new column
         list includes anything not yet in saved column list.
         """
-        refresh_info = self.survey_refresh_info(page_id)
-        saved_columns = refresh_info.get('column_list', '').split(',')
+        # Only trust the cache to say nothing is missing: another process may
+        # have added columns since, so check before dropping anything.
+        saved_columns = self.cached_column_list(page_id)
+        if saved_columns is None or set(column_list) - set(saved_columns):
+            saved_columns = self.saved_column_list(page_id)
+            self.cache_column_list(page_id, saved_columns)
         return len(list(set(column_list) - set(saved_columns))) > 0
 
+    def saved_column_list(self, page_id):
+        """
+        Column list from the pages record for given survey page_id.
+        """
+        column_list_query = SQL("""
+        SELECT column_list
+        FROM {}
+        WHERE page_id = %s
+        """).format(self.survey_table('pages'))
+        self.database_cursor.execute(column_list_query, (int(page_id),))
+        result = self.database_cursor.fetchone()
+        if result is None:
+            raise PageNotLoadedException(
+                'Results for survey %d have not yet been loaded.'
+                % int(page_id)
+            )
+        return (result.get('column_list') or '').split(',')
+
+    def cached_column_list(self, page_id):
+        """
+        Saved column list for given survey page_id, if cached and not expired.
+        """
+        key = (self.settings.DB_SCHEMA_SURVEY, int(page_id))
+        expires_at, column_list = column_list_cache.get(key, (0, None))
+        if expires_at < time.monotonic():
+            return None
+        return column_list
+
+    def cache_column_list(self, page_id, column_list):
+        """
+        Cache saved column list for given survey page_id.
+        """
+        key = (self.settings.DB_SCHEMA_SURVEY, int(page_id))
+        column_list_cache[key] = (
+            time.monotonic() + COLUMN_LIST_TTL_SECONDS,
+            column_list
+        )
+
+    def forget_column_list(self, page_id):
+        """
+        Drop cached column list for given survey page_id.
+        """
+        key = (self.settings.DB_SCHEMA_SURVEY, int(page_id))
+        column_list_cache.pop(key, None)
+
     def column_list_for_survey(self, page_id):
         """
         Full column list for given survey page_id.
         """
-        excludes = self.settings.COLUMN_EXCLUDES.split(',')
-        column_query = """
+        column_query = SQL("""
         SELECT DISTINCT af.name
-        FROM %s.core_actionfield af
-        JOIN %s.core_action a ON a.id = af.parent_id
-        WHERE a.page_id = %d
-        AND NOT af.name = ANY(%s)
-        """ % (
-            self.settings.DB_SCHEMA_AK,
-            self.settings.DB_SCHEMA_AK,
-            int(page_id),
-            '%s'
+        FROM {} af
+        JOIN {} a ON a.id = af.parent_id
+        WHERE a.page_id = %s
+        AND NOT EXISTS (
+            SELECT 1 FROM column_excludes e WHERE e.name = af.name
+        )
+        """).format(
+            self.ak_table('core_actionfield'),
+            self.ak_table('core_action')
         )
-        self.database_cursor.execute(column_query, (excludes, ))
-        column_result = list(self.database_cursor.fetchall())
-        field_names = [item.get('name', '') for item in column_result]
+        with self.database.cursor() as cursor:
+            cursor.execute(column_query, (int(page_id),))
+            field_names = [row[0] for row in cursor.fetchall()]
         field_names.sort()
         return self.sluggified_field_names(field_names)
 
@@ -266,116 +595,193 @@ class AKSurveyResults:
         """
         Recreate a survey's table structure.
         """
-        drop_query = """
-        DROP TABLE IF EXISTS %s.page_%d
-        """ % (self.settings.DB_SCHEMA_SURVEY, int(page_id))
-        self.database_cursor.execute(drop_query)
-        create_columns = ['%s %s' % (column, self.varchar_col_type)
-                          for column in column_list]
-        create_columns.insert(0, 'action_id INTEGER')
-        create_query = """
-        CREATE TABLE %s.page_%d (%s)
-        """ % (
-            self.settings.DB_SCHEMA_SURVEY,
-            int(page_id),
-            ', '.join(create_columns)
+        self.forget_column_list(page_id)
+        create_columns = [
+            SQL('{} {}').format(Identifier(column), SQL(self.varchar_col_type))
+            for column in column_list
+        ]
+        if self.settings.DB_TYPE.lower() == 'redshift':
+            create_columns.insert(0, SQL('action_id INTEGER'))
+        else:
+            create_columns.insert(0, SQL('action_id INTEGER PRIMARY KEY'))
+        recreate_query = SQL("""
+        DROP TABLE IF EXISTS {0};
+        CREATE TABLE {0} ({1})
+        """).format(
+            self.page_table(page_id),
+            SQL(', ').join(create_columns)
         )
-        self.database_cursor.execute(create_query)
+        self.database_cursor.execute(recreate_query)
         self.database.commit()
 
-    def insert_rows_from_field_values(
-        self, page_id, field_values, column_names
-    ):
+    def insert_rows_from_field_values(self, page_id, field_values, name_map):
+        """
+        Insert results into survey_results table, with each field name's
+        values going into the column given by name_map.
         """
-        Insert results into survey_results table.
-        """
-        insert_columns = ['action_id'] + column_names
-        insert_values = []
-        action_ids = []
-        for action_id, values in field_values.items():
-            insert_values.append(action_id)
-            action_ids.append(action_id)
-            for column in column_names:
-                insert_values.append(values.get(column, ''))
-        delete_query = """
-        DELETE FROM %s.page_%d WHERE action_id = ANY(%s)
-        """ % (
-            self.settings.DB_SCHEMA_SURVEY,
-            int(page_id),
-            '%s'
+        field_names = list(name_map)
+        insert_columns = ['action_id'] + [
+            name_map[name] for name in field_names
+        ]
+        rows = (
+            (action_id, *[values.get(name, '') for name in field_names])
+            for action_id, values in field_values.items()
         )
-        self.database_cursor.execute(delete_query, (action_ids,))
-        self.database.commit()
-        insert_query = """
-        INSERT INTO %s.page_%d (%s) VALUES %s
-        """ % (
-            self.settings.DB_SCHEMA_SURVEY,
-            int(page_id),
-            ', '.join(insert_columns),
-            """,
-            """.join([
-                '(%s)' % ', '.join([
-                    '%s' for column in insert_columns
-                ]) for row in field_values.keys()
-            ])
+        insert_query = SQL("""
+        INSERT INTO {} ({}) VALUES %s
+        """).format(
+            self.page_table(page_id),
+            SQL(', ').join(Identifier(column) for column in insert_columns)
         )
-        self.database_cursor.execute(insert_query, insert_values)
+        try:
+            if self.settings.DB_TYPE.lower() == 'redshift':
+                # Redshift has neither ON CONFLICT nor COPY FROM STDIN, so
+                # replace rows with DELETE and INSERT in one transaction.
+                delete_query = SQL("""
+                DELETE FROM {} WHERE action_id = ANY(%s)
+                """).format(self.page_table(page_id))
+                self.database_cursor.execute(
+                    delete_query, (list(field_values),)
+                )
+                psycopg2.extras.execute_values(
+                    self.database_cursor, insert_query, rows,
+                    page_size=INSERT_PAGE_SIZE
+                )
+            elif len(field_values) > INSERT_PAGE_SIZE:
+                self.upsert_rows_with_copy(page_id, insert_columns, rows)
+            else:
+                psycopg2.extras.execute_values(
+                    self.database_cursor,
+                    insert_query + self.on_conflict_update(insert_columns[1:]),
+                    rows,
+                    page_size=INSERT_PAGE_SIZE
+                )
+        except psycopg2.errors.UndefinedTable as e:
+            # Cached column list outlived the table.
+            self.database.rollback()
+            self.forget_column_list(page_id)
+            raise PageNotLoadedException(
+                'Results table for survey %d does not exist.' % int(page_id)
+            ) from e
+        except psycopg2.errors.InvalidColumnReference as e:
+            # Table predates the action_id primary key, so add it in place,
+            # only rebuilding the table if that fails.
+            self.database.rollback()
+            try:
+                self.add_primary_key(page_id)
+            except psycopg2.Error as key_error:
+                self.database.rollback()
+                self.forget_column_list(page_id)
+                raise PageNotLoadedException(
+                    'Results table for survey %d has no primary key.'
+                    % int(page_id)
+                ) from key_error
+            return self.insert_rows_from_field_values(
+                page_id, field_values, name_map
+            )
         self.database.commit()
 
-    def add_to_pages_table(self, page_id, column_list):
+    def add_primary_key(self, page_id):
         """
-        Insert the record for a given survey page.
+        Make action_id the primary key of a survey's table, first removing
+        duplicate and missing action IDs.
         """
-        insert_query = """
-        INSERT INTO %s.pages
-        (page_id, column_list, last_refresh)
-        VALUES
-        (%d, '%s', '1900-01-01 00:00:00')
-        """ % (
-            self.settings.DB_SCHEMA_SURVEY,
-            int(page_id),
-            ','.join(column_list)
-        )
-        self.database_cursor.execute(insert_query)
+        primary_key_query = SQL("""
+        DELETE FROM {0} a
+        USING {0} b
+        WHERE a.action_id = b.action_id
+        AND a.ctid < b.ctid;
+        DELETE FROM {0} WHERE action_id IS NULL;
+        ALTER TABLE {0} ADD PRIMARY KEY (action_id)
+        """).format(self.page_table(page_id))
+        self.database_cursor.execute(primary_key_query)
         self.database.commit()
 
-    def delete_from_pages_table(self, page_id):
+    def upsert_rows_with_copy(self, page_id, columns, rows):
+        """
+        COPY rows into a temporary staging table, then upsert them into the
+        survey's table with a single INSERT ... SELECT. This takes three
+        statements, so it only pays off for more rows than one INSERT takes.
+        """
+        staging_table = Identifier('page_%d_staging' % int(page_id))
+        column_identifiers = SQL(', ').join(
+            Identifier(column) for column in columns
+        )
+        staging_query = SQL("""
+        CREATE TEMPORARY TABLE {} (LIKE {}) ON COMMIT DROP
+        """).format(staging_table, self.page_table(page_id))
+        self.database_cursor.execute(staging_query)
+        copy_query = SQL("""
+        COPY {} ({}) FROM STDIN
+        """).format(staging_table, column_identifiers)
+        self.database_cursor.copy_expert(
+            copy_query.as_string(self.database_cursor), CopyTextReader(rows)
+        )
+        upsert_query = SQL("""
+        INSERT INTO {} ({})
+        SELECT {} FROM {}
+        """).format(
+            self.page_table(page_id),
+            column_identifiers,
+            column_identifiers,
+            staging_table
+        ) + self.on_conflict_update(columns[1:])
+        self.database_cursor.execute(upsert_query)
+
+    def on_conflict_update(self, column_names):
+        """
+        ON CONFLICT clause replacing given columns of existing action rows.
+        """
+        if not column_names:
+            return SQL(' ON CONFLICT (action_id) DO NOTHING')
+        return SQL(' ON CONFLICT (action_id) DO UPDATE SET {}').format(
+            SQL(', ').join(
+                SQL('{0} = EXCLUDED.{0}').format(Identifier(column))
+                for column in column_names
+            )
+        )
+
+    def replace_in_pages_table(self, page_id, column_list):
         """
-        Delete the record for a given survey page.
+        Replace the record for a given survey page, resetting last_refresh.
         """
-        delete_query = """
-        DELETE FROM %s.pages
-        WHERE page_id = %d
-        """ % (
-            self.settings.DB_SCHEMA_SURVEY,
-            int(page_id)
+        self.forget_column_list(page_id)
+        replace_query = SQL("""
+        DELETE FROM {0}
+        WHERE page_id = %s;
+        INSERT INTO {0}
+        (page_id, column_list, last_refresh)
+        VALUES
+        (%s, %s, '1900-01-01 00:00:00')
+        """).format(self.survey_table('pages'))
+        self.database_cursor.execute(
+            replace_query,
+            (int(page_id), int(page_id), ','.join(column_list))
         )
-        self.database_cursor.execute(delete_query)
         self.database.commit()
 
     def update_pages_table_refresh(self, page_id, last_refresh):
         """
         Update the record for a given survey page.
         """
+        params = (int(page_id),)
+        refresh_value = SQL('GETDATE()')
         if last_refresh != 'GETDATE()':
-            last_refresh = "'%s'" % last_refresh
-        update_query = """
-        UPDATE %s.pages
-        SET last_refresh = %s
-        WHERE page_id = %d
-        """ % (
-            self.settings.DB_SCHEMA_SURVEY,
-            last_refresh,
-            int(page_id)
-        )
-        self.database_cursor.execute(update_query)
+            params = (last_refresh, int(page_id))
+            refresh_value = SQL('%s')
+        update_query = SQL("""
+        UPDATE {}
+        SET last_refresh = {}
+        WHERE page_id = %s
+        """).format(self.survey_table('pages'), refresh_value)
+        self.database_cursor.execute(update_query, params)
         self.database.commit()
 
     def surveys_that_need_updating(self, count):
         """
         Get a list of survey page IDs that need updating.
         """
-        needs_update_query = """
+        needs_update_query = SQL("""
         SELECT
             DISTINCT p.id AS page_id,
             CASE
@@ -383,30 +789,40 @@ class AKSurveyResults:
                 THEN sr.last_refresh
                 ELSE '1900-01-01 00:00:00'
             END AS since
-        FROM %s.core_action a
-        JOIN %s.core_page p ON p.id = a.page_id
-        LEFT JOIN %s.pages sr ON sr.page_id = p.id
+        FROM {} a
+        JOIN {} p ON p.id = a.page_id
+        LEFT JOIN {} sr ON sr.page_id = p.id
         WHERE p.type = 'Survey'
           AND (sr.page_id IS NULL
                OR sr.last_refresh < a.created_at)
         ORDER BY since
-        LIMIT %d
-        """ % (
-            self.settings.DB_SCHEMA_AK,
-            self.settings.DB_SCHEMA_AK,
-            self.settings.DB_SCHEMA_SURVEY,
-            count
+        LIMIT %s
+        """).format(
+            self.ak_table('core_action'),
+            self.ak_table('core_page'),
+            self.survey_table('pages')
         )
-        self.database_cursor.execute(needs_update_query)
+        self.database_cursor.execute(needs_update_query, (int(count),))
         return list(self.database_cursor.fetchall())
 
     def process_recent_actions_for_survey(self, page_id, since):
         actions = self.recent_actions_for_survey(page_id, since)
-        action_ids = [action.get('id') for action in actions]
+        action_ids = [action[0] for action in actions]
+        field_values = {}
+        if len(actions):
+            field_values = self.field_values_by_action(
+                self.field_values_for_actions(action_ids), action_ids
+            )
+        return self.process_actions_for_survey(page_id, actions, field_values)
+
+    def process_actions_for_survey(self, page_id, actions, field_values):
+        """
+        Save already fetched actions and their field values (by action) for
+        a survey, recreating the survey table if its columns have changed.
+        """
         if len(actions):
-            field_values = self.field_values_for_actions(action_ids)
-            field_names = self.unique_field_names(field_values)
-            field_slugs = self.sluggified_field_names(field_names)
+            field_names, field_slugs, name_map = \
+                self.field_names_and_slugs(field_values)
             try:
                 needs_recreating = self.survey_table_needs_recreating(
                     page_id, field_slugs
@@ -414,21 +830,14 @@ class AKSurveyResults:
                 if needs_recreating:
                     all_columns = self.column_list_for_survey(page_id)
                     self.recreate_survey_table(page_id, all_columns)
-                    self.delete_from_pages_table(page_id)
-                    self.add_to_pages_table(page_id, all_columns)
+                    self.replace_in_pages_table(page_id, all_columns)
                     return {
                         'outcome': 'survey schema updated',
                         'reason': 'column(s) added'
                     }
                 else:
                     self.insert_rows_from_field_values(
-                        page_id,
-                        self.field_values_by_action(
-                            field_values,
-                            dict(zip(field_names, field_slugs)),
-                            action_ids
-                        ),
-                        field_slugs
+                        page_id, field_values, name_map
                     )
                     self.update_pages_table_refresh(
                         page_id,
@@ -441,7 +850,7 @@ class AKSurveyResults:
             except PageNotLoadedException as e:
                 all_columns = self.column_list_for_survey(page_id)
                 self.recreate_survey_table(page_id, all_columns)
-                self.add_to_pages_table(page_id, all_columns)
+                self.replace_in_pages_table(page_id, all_columns)
                 return {
                     'outcome': 'survey schema updated',
                     'reason': 'survey schema missing'
@@ -449,41 +858,79 @@ class AKSurveyResults:
         else:
             self.update_pages_table_refresh(page_id, 'GETDATE()')
 
-    def process_surveys_that_need_updating(self, surveys, lambda_name=False):
+    def process_surveys_that_need_updating(
+        self, surveys, lambda_name=False, queue_url=False
+    ):
         """
-        Call process_recent_actions_for_survey on each survey.
+        Call process_recent_actions_for_survey on each survey. With a queue,
+        surveys are sent to SQS for a Lambda event source to process. With a
+        Lambda function, surveys are split into about sqrt(N) batches, each
+        sent to process_surveys_batch, which in turn invokes one Lambda per
+        survey.
         """
-        if lambda_name:
-            client = boto3.client('lambda')
-            for survey in surveys:
-                payload = dumps({
-                    'FUNCTION': 'process_recent_actions_for_survey',
-                    'PAGE_ID': survey.get('page_id'),
-                    'SINCE': survey.get('since')
-                }, default=json_serial)
-                client.invoke(
-                    FunctionName=lambda_name,
-                    InvocationType='Event',
-                    Payload=payload
-                )
+        if queue_url:
+            failed = send_to_queue(queue_url, surveys)
+            return {
+                'outcome': 'queued',
+                'surveys': surveys,
+                'failed': failed
+            }
+        elif lambda_name:
+            batch_size = max(1, math.ceil(math.sqrt(len(surveys))))
+            invoke_lambda_for_each(lambda_name, [
+                {
+                    'FUNCTION': 'process_surveys_batch',
+                    'SURVEYS': surveys[start:start + batch_size],
+                    'LAMBDA': lambda_name
+                } for start in range(0, len(surveys), batch_size)
+            ])
             return {
                 'outcome': 'processing asynchronously',
                 'surveys': surveys
             }
         else:
+            # Fetch actions and field values for all surveys up front, one
+            # query each, rather than per survey.
+            actions_by_page = self.recent_actions_for_surveys(surveys)
+            action_ids = [
+                action[0]
+                for actions in actions_by_page.values()
+                for action in actions
+            ]
+            field_values = {}
+            if action_ids:
+                field_values = self.field_values_by_action(
+                    self.field_values_for_actions(action_ids), action_ids
+                )
             results = {}
             for survey in surveys:
-                results[survey.get('page_id')] = \
-                    self.process_recent_actions_for_survey(
-                        survey.get('page_id'),
-                        survey.get('since')
-                    )
+                page_id = int(survey.get('page_id'))
+                actions = actions_by_page.get(page_id, [])
+                results[page_id] = self.process_actions_for_survey(
+                    page_id,
+                    actions,
+                    {
+                        action[0]: field_values[action[0]]
+                        for action in actions
+                    }
+                )
             return {
                 'outcome': 'processed',
                 'surveys': surveys,
                 'results': results
             }
 
+    def process_surveys_batch(self, surveys, lambda_name=False):
+        """
+        Invoke process_recent_actions_for_survey for each survey in a batch,
+        or process the batch synchronously if no Lambda function is given.
+        """
+        if isinstance(surveys, str):
+            surveys = loads(surveys)
+        if not lambda_name:
+            return self.process_surveys_that_need_updating(surveys)
+        return invoke_lambda_for_surveys(lambda_name, surveys)
+
 
 class Struct:
     def __init__(self, **entries):
@@ -491,20 +938,29 @@ class Struct:
 
 
 def main(args):
-    ak = AKSurveyResults(args)
     print('running main')
     print(args.__dict__.get('FUNCTION', ''), 'FUNCTION')
     print(args.__dict__.get('PAGE_ID', ''), 'PAGE_ID')
     print(args.__dict__.get('SINCE', ''), 'SINCE')
-    if args.FUNCTION == 'survey_refresh_info':
-        return ak.survey_refresh_info(args.PAGE_ID)
-    elif args.FUNCTION == 'surveys_that_need_updating':
-        return ak.surveys_that_need_updating(15)
-    elif args.FUNCTION == 'process_surveys_that_need_updating':
-        surveys = ak.surveys_that_need_updating(15)
-        return ak.process_surveys_that_need_updating(surveys, args.LAMBDA)
-    elif args.FUNCTION == 'process_recent_actions_for_survey':
-        return ak.process_recent_actions_for_survey(args.PAGE_ID, args.SINCE)
+    if args.FUNCTION == 'process_surveys_batch' and args.LAMBDA:
+        # Dispatching a batch needs no database connection.
+        return invoke_lambda_for_surveys(args.LAMBDA, args.SURVEYS)
+    with AKSurveyResults(args) as ak:
+        if args.FUNCTION == 'survey_refresh_info':
+            return ak.survey_refresh_info(args.PAGE_ID)
+        elif args.FUNCTION == 'surveys_that_need_updating':
+            return ak.surveys_that_need_updating(15)
+        elif args.FUNCTION == 'process_surveys_that_need_updating':
+            surveys = ak.surveys_that_need_updating(15)
+            return ak.process_surveys_that_need_updating(
+                surveys, args.LAMBDA, args.QUEUE
+            )
+        elif args.FUNCTION == 'process_surveys_batch':
+            return ak.process_surveys_batch(args.SURVEYS, args.LAMBDA)
+        elif args.FUNCTION == 'process_recent_actions_for_survey':
+            return ak.process_recent_actions_for_survey(
+                args.PAGE_ID, args.SINCE
+            )
     return False
 
 
@@ -515,11 +971,127 @@ def json_serial(obj):
     raise TypeError("Type %s not serializable." % type(obj))
 
 
+def invoke_lambda_for_each(lambda_name, payloads):
+    """
+    Asynchronously invoke a Lambda function once per payload, sending the
+    invocations concurrently over a single client.
+    """
+    client = boto3.client('lambda')
+
+    def invoke(payload):
+        return client.invoke(
+            FunctionName=lambda_name,
+            InvocationType='Event',
+            Payload=dumps(payload, default=json_serial)
+        )
+
+    with ThreadPoolExecutor(max_workers=INVOKE_WORKERS) as executor:
+        return list(executor.map(invoke, payloads))
+
+
+def invoke_lambda_for_surveys(lambda_name, surveys):
+    """
+    Invoke process_recent_actions_for_survey once per survey in a batch.
+    """
+    if isinstance(surveys, str):
+        surveys = loads(surveys)
+    invoke_lambda_for_each(lambda_name, [
+        {
+            'FUNCTION': 'process_recent_actions_for_survey',
+            'PAGE_ID': survey.get('page_id'),
+            'SINCE': survey.get('since')
+        } for survey in surveys
+    ])
+    return {
+        'outcome': 'processing asynchronously',
+        'surveys': surveys
+    }
+
+
+def send_to_queue(queue_url, surveys):
+    """
+    Send surveys to an SQS queue, retrying once any entries SQS failed to
+    accept through no fault of the request. Returns entries that still
+    failed.
+    """
+    client = boto3.client('sqs')
+    entries = [
+        {
+            'Id': str(index),
+            'MessageBody': dumps({
+                'page_id': survey.get('page_id'),
+                'since': survey.get('since')
+            }, default=json_serial)
+        } for index, survey in enumerate(surveys)
+    ]
+    failed = send_message_batches(client, queue_url, entries)
+    # Sender faults would only fail again, so just retry the rest.
+    retry_ids = set(
+        entry.get('Id') for entry in failed if not entry.get('SenderFault')
+    )
+    if retry_ids:
+        failed = [
+            entry for entry in failed if entry.get('SenderFault')
+        ] + send_message_batches(client, queue_url, [
+            entry for entry in entries if entry['Id'] in retry_ids
+        ])
+    for entry in failed:
+        print(
+            'failed to queue survey',
+            surveys[int(entry.get('Id'))].get('page_id'),
+            entry.get('Message')
+        )
+    return failed
+
+
+def send_message_batches(client, queue_url, entries):
+    """
+    Send entries to an SQS queue, up to ten per request. Returns any
+    entries SQS failed to accept.
+    """
+    failed = []
+    for start in range(0, len(entries), QUEUE_BATCH_SIZE):
+        response = client.send_message_batch(
+            QueueUrl=queue_url,
+            Entries=entries[start:start + QUEUE_BATCH_SIZE]
+        )
+        failed += response.get('Failed', [])
+    return failed
+
+
+def process_queue_records(records):
+    """
+    Process surveys delivered by an SQS event source one at a time, so one
+    failing survey doesn't hold back the rest of the batch. Failed messages
+    are reported for SQS to retry on their own.
+    """
+    failures = []
+    args = Struct(**{
+        argname: settings.get(argname, False) for argname in ARG_DEFINITIONS
+    })
+    with AKSurveyResults(args) as ak:
+        for record in records:
+            if record.get('eventSource') != 'aws:sqs':
+                continue
+            try:
+                survey = loads(record.get('body'))
+                ak.process_recent_actions_for_survey(
+                    survey.get('page_id'), survey.get('since')
+                )
+            except Exception as e:
+                print('failed to process message', record.get('messageId'), e)
+                failures.append({'itemIdentifier': record.get('messageId')})
+                ak.reset_connection()
+    return {'batchItemFailures': failures}
+
+
 def aws_lambda(event, context):
     """
     General entry point via Amazon Lambda event.
     """
     print('running aws_lambda')
+    if 'Records' in event:
+        return process_queue_records(event.get('Records') or [])
     kwargs = event.get('kwargs', False)
     if kwargs:
         for argname in kwargs:
@@ -1,6 +1,9 @@
 import pytest
 import boto3
+import datetime
 import json
+import psycopg2
+from unittest import mock
 from moto import mock_secretsmanager
 from pywell.secrets_manager import get_secret
 
@@ -20,6 +23,19 @@ def init_secrets():
     client.create_secret(Name='redshift-admin', SecretString=json.dumps(redshift_secret))
 
 
+def terminate_backend(backend_pid):
+    admin = psycopg2.connect(
+        host=redshift_secret['host'],
+        port=redshift_secret['port'],
+        user=redshift_secret['username'],
+        password=redshift_secret['password'],
+        database=redshift_secret['dbName']
+    )
+    admin.autocommit = True
+    admin.cursor().execute('SELECT pg_terminate_backend(%s)', (backend_pid,))
+    admin.close()
+
+
 @mock_secretsmanager
 class Test:
 
@@ -30,7 +46,8 @@ class Test:
         self.args['PAGE_ID']=1
         self.args['SINCE']=60
 
-        from ak_survey_results import AKSurveyResults
+        from ak_survey_results import AKSurveyResults, column_list_cache
+        column_list_cache.clear()
         self.survey_results = AKSurveyResults(ArgsObject(self.args))
 
         create_survey_schema_query = """
@@ -102,6 +119,7 @@ class Test:
         INSERT INTO %s.core_actionfield (id, parent_id, name, value)
         VALUES
         (1, 1, 'name', 'value'),
+        (4, 1, 'name', 'another value'),
         (2, 2, 'another', 'a value'),
         (3, 3, 'processed', 'yes')
         """ % self.args['DB_SCHEMA_AK']
@@ -139,6 +157,27 @@ class Test:
         assert len(sluggified_names) == len(assert_names)
         assert sluggified_names == assert_names
 
+    def test_slugify_field_name(self):
+        from ak_survey_results import custom_slugify, slugify_field_name
+        names = [
+            'zip', 'first_name', 'q1', '1st', 'abc\n', 'a__b', '_a', 'a_',
+            'Zip Code', 'what?', 'caf\u00e9'
+        ]
+        for name in names:
+            assert slugify_field_name(name) == custom_slugify(name)
+
+    def test_deduped_columns(self):
+        columns = ['a', 'a', 'a', '', 'join', '1st']
+        assert_columns = ['a', 'a2', 'a3', 'unnamed_field', 'join_q', 'q_1st']
+        assert self.survey_results.deduped_columns(columns) == assert_columns
+        # Suffixed names must not collide with real columns
+        columns = ['zip', 'zip', 'zip2']
+        assert_columns = ['zip', 'zip2', 'zip22']
+        assert self.survey_results.deduped_columns(columns) == assert_columns
+        columns = ['a', 'a2', 'a', 'a']
+        assert_columns = ['a', 'a2', 'a3', 'a4']
+        assert self.survey_results.deduped_columns(columns) == assert_columns
+
     def test_survey_refresh_info(self):
         from ak_survey_results import PageNotFoundException
         from ak_survey_results import PageNotSurveyException
@@ -158,10 +197,76 @@ class Test:
     def test_recent_actions_for_survey(self):
         actions = self.survey_results.recent_actions_for_survey(2)
         assert len(actions) == 1
-        assert actions[0].get('id', 0) == 1
+        assert actions[0][0] == 1
         no_actions = self.survey_results.recent_actions_for_survey(1)
         assert no_actions == []
 
+    def test_recent_actions_for_surveys(self):
+        actions = self.survey_results.recent_actions_for_surveys([
+            {'page_id': 2, 'since': '1900-01-01 00:00:00'},
+            {'page_id': 3, 'since': '2018-10-06 00:00:00'},
+            {'page_id': 4, 'since': '1900-01-01 00:00:00'}
+        ])
+        assert sorted(actions.keys()) == [2, 4]
+        assert [action[0] for action in actions[2]] == [1]
+        assert [action[0] for action in actions[4]] == [3]
+        assert self.survey_results.recent_actions_for_surveys([]) == {}
+
+    def test_recent_actions_for_surveys_limit(self):
+        actions_query = """
+        INSERT INTO %s.core_action (id, page_id, created_at)
+        SELECT 100 + n, 5, TIMESTAMP '2018-11-01' + n * INTERVAL '1 second'
+        FROM generate_series(1, 10001) n
+        """ % self.args['DB_SCHEMA_AK']
+        self.survey_results.database_cursor.execute(actions_query)
+        actions = self.survey_results.recent_actions_for_surveys([
+            {'page_id': 2, 'since': '1900-01-01 00:00:00'},
+            {'page_id': 5, 'since': '1900-01-01 00:00:00'}
+        ])
+        assert [action[0] for action in actions[2]] == [1]
+        assert [action[0] for action in actions[5]] == list(range(101, 10101))
+
+    def test_survey_table_needs_recreating(self):
+        assert not self.survey_results.survey_table_needs_recreating(
+            4, ['processed']
+        )
+        assert self.survey_results.survey_table_needs_recreating(
+            4, ['processed', 'new']
+        )
+        # A stale cached list missing a column is rechecked, not trusted.
+        self.survey_results.cache_column_list(4, ['old'])
+        assert not self.survey_results.survey_table_needs_recreating(
+            4, ['processed']
+        )
+
+    def test_column_excludes(self):
+        from ak_survey_results import AKSurveyResults
+        args = dict(self.args, COLUMN_EXCLUDES='name,processed')
+        with AKSurveyResults(ArgsObject(args)) as survey_results:
+            assert list(survey_results.field_values_for_actions([1, 2])) == [
+                (2, 'another', 'a value')
+            ]
+            assert survey_results.column_list_for_survey(2) == []
+            assert survey_results.column_list_for_survey(3) == ['another']
+        # Empty names are dropped rather than loaded as excludes.
+        for column_excludes, names in [
+            (False, []), ('', []), ('processed,,', ['processed'])
+        ]:
+            args = dict(self.args, COLUMN_EXCLUDES=column_excludes)
+            with AKSurveyResults(ArgsObject(args)) as survey_results:
+                survey_results.database_cursor.execute(
+                    'SELECT name FROM column_excludes'
+                )
+                assert [
+                    row['name']
+                    for row in survey_results.database_cursor.fetchall()
+                ] == names
+        args = dict(self.args, COLUMN_EXCLUDES=False)
+        with AKSurveyResults(ArgsObject(args)) as survey_results:
+            assert survey_results.column_list_for_survey(2) == ['name']
+            results = survey_results.survey_refresh_info(4)
+            assert results.get('saved_count', 0) == 1
+
     def test_surveys_that_need_updating(self):
         surveys = self.survey_results.surveys_that_need_updating(10)
         assert len(surveys) == 2
@@ -174,11 +279,49 @@ class Test:
         assert survey_status.get('action_count', False) == 1
         assert survey_status.get('saved_count', False) == 0
         self.survey_results.process_recent_actions_for_survey(2, '1900-01-01 00:00:00')
+        self.survey_results.database_cursor.execute(
+            "SELECT action_id, name FROM %s.page_2" % self.args['DB_SCHEMA_SURVEY']
+        )
+        rows = self.survey_results.database_cursor.fetchall()
+        assert rows == [{'action_id': 1, 'name': 'value; another value'}]
         surveys = self.survey_results.surveys_that_need_updating(10)
         assert len(surveys) == 1
         survey_ids = sorted([survey.get('page_id') for survey in surveys])
         assert survey_ids == [3]
 
+    def test_process_recent_actions_for_saved_survey(self):
+        # page_4 predates the action_id primary key and has a duplicate row.
+        page_4_query = "SELECT action_id, processed FROM %s.page_4" % (
+            self.args['DB_SCHEMA_SURVEY']
+        )
+        self.survey_results.database_cursor.execute(
+            "INSERT INTO %s.page_4 (action_id, processed) VALUES (3, 'yes')"
+            % self.args['DB_SCHEMA_SURVEY']
+        )
+        self.survey_results.database.commit()
+        result = self.survey_results.process_recent_actions_for_survey(
+            4, '1900-01-01 00:00:00'
+        )
+        assert result == {'outcome': 'processed', 'actions': 1}
+        self.survey_results.database_cursor.execute(page_4_query)
+        rows = self.survey_results.database_cursor.fetchall()
+        assert rows == [{'action_id': 3, 'processed': 'yes'}]
+        # Re-processing a saved action updates its row in place.
+        self.survey_results.database_cursor.execute(
+            "UPDATE %s.core_actionfield SET value = 'no' WHERE parent_id = 3"
+            % self.args['DB_SCHEMA_AK']
+        )
+        self.survey_results.database.commit()
+        result = self.survey_results.process_recent_actions_for_survey(
+            4, '1900-01-01 00:00:00'
+        )
+        assert result == {'outcome': 'processed', 'actions': 1}
+        self.survey_results.database_cursor.execute(page_4_query)
+        rows = self.survey_results.database_cursor.fetchall()
+        assert rows == [{'action_id': 3, 'processed': 'no'}]
+        survey_status = self.survey_results.survey_refresh_info(4)
+        assert survey_status.get('last_refresh') != datetime.datetime(1900, 1, 1)
+
     def test_process_surveys_that_need_updating(self):
         surveys = self.survey_results.surveys_that_need_updating(10)
         self.survey_results.process_surveys_that_need_updating(surveys)
@@ -189,6 +332,206 @@ class Test:
         surveys_after = self.survey_results.surveys_that_need_updating(10)
         assert surveys_after == []
 
+    def test_process_special_field_values(self):
+        self.survey_results.database_cursor.execute(
+            """
+            INSERT INTO %s.core_actionfield (id, parent_id, name, value)
+            VALUES (5, 2, 'empty', NULL), (6, 2, 'notes', %%s)
+            """ % self.args['DB_SCHEMA_AK'],
+            ('tab\there\nnew line \\N',)
+        )
+        self.survey_results.database.commit()
+        self.survey_results.process_recent_actions_for_survey(3, '1900-01-01 00:00:00')
+        # Saved first through COPY, then again through INSERT.
+        for insert_page_size in [0, 1000]:
+            with mock.patch(
+                'ak_survey_results.INSERT_PAGE_SIZE', insert_page_size
+            ):
+                self.survey_results.process_recent_actions_for_survey(
+                    3, '1900-01-01 00:00:00'
+                )
+            self.survey_results.database_cursor.execute(
+                "SELECT action_id, another, empty, notes FROM %s.page_3"
+                % self.args['DB_SCHEMA_SURVEY']
+            )
+            rows = self.survey_results.database_cursor.fetchall()
+            assert rows == [{
+                'action_id': 2,
+                'another': 'a value',
+                'empty': None,
+                'notes': 'tab\there\nnew line \\N'
+            }]
+
+    def test_copy_text_reader(self):
+        from ak_survey_results import CopyTextReader
+        reader = CopyTextReader(iter([(1, 'a\tb'), (2, None)]))
+        chunks = []
+        chunk = reader.read(5)
+        while chunk:
+            chunks.append(chunk)
+            chunk = reader.read(5)
+        assert all(len(chunk) <= 5 for chunk in chunks)
+        assert ''.join(chunks) == '1\ta\\tb\n2\t\\N\n'
+        assert CopyTextReader(iter([(1, 'a')])).read() == '1\ta\n'
+
+    def test_process_surveys_batch_with_string_ids(self):
+        surveys = json.dumps([
+            {'page_id': '3', 'since': '1900-01-01T00:00:00'}
+        ])
+        self.survey_results.process_surveys_batch(surveys)
+        self.survey_results.process_surveys_batch(surveys)
+        survey_status = self.survey_results.survey_refresh_info(3)
+        assert survey_status.get('saved_count', False) == 1
+
+    def test_process_surveys_that_need_updating_with_lambda(self):
+        surveys = [
+            {'page_id': page_id, 'since': datetime.datetime(2018, 10, 1)}
+            for page_id in range(1, 10)
+        ]
+        with mock.patch('ak_survey_results.boto3.client') as client:
+            self.survey_results.process_surveys_that_need_updating(
+                surveys, 'survey-lambda'
+            )
+        payloads = [
+            json.loads(call.kwargs['Payload'])
+            for call in client.return_value.invoke.call_args_list
+        ]
+        assert len(payloads) == 3
+        assert all(
+            payload['FUNCTION'] == 'process_surveys_batch'
+            for payload in payloads
+        )
+        assert [len(payload['SURVEYS']) for payload in payloads] == [3, 3, 3]
+        assert all(
+            payload['LAMBDA'] == 'survey-lambda' for payload in payloads
+        )
+
+        from ak_survey_results import main
+        batch_args = dict(self.args, **payloads[0])
+        with mock.patch('ak_survey_results.boto3.client') as client, \
+                mock.patch('ak_survey_results.AKSurveyResults') as ak:
+            main(ArgsObject(batch_args))
+        ak.assert_not_called()
+        payloads = sorted([
+            json.loads(call.kwargs['Payload'])
+            for call in client.return_value.invoke.call_args_list
+        ], key=lambda payload: payload['PAGE_ID'])
+        assert payloads == [
+            {
+                'FUNCTION': 'process_recent_actions_for_survey',
+                'PAGE_ID': page_id,
+                'SINCE': '2018-10-01T00:00:00'
+            } for page_id in [1, 2, 3]
+        ]
+        for call in client.return_value.invoke.call_args_list:
+            assert call.kwargs['FunctionName'] == 'survey-lambda'
+            assert call.kwargs['InvocationType'] == 'Event'
+
+    def test_dead_pooled_connection_is_replaced(self):
+        from ak_survey_results import AKSurveyResults
+        backend_pid = self.survey_results.database.get_backend_pid()
+        self.survey_results.close()
+        terminate_backend(backend_pid)
+        self.survey_results = AKSurveyResults(ArgsObject(self.args))
+        assert self.survey_results.database.get_backend_pid() != backend_pid
+        results = self.survey_results.survey_refresh_info(4)
+        assert results.get('saved_count', 0) == 1
+
+    def test_send_to_queue(self):
+        from ak_survey_results import send_to_queue
+        surveys = [
+            {'page_id': page_id, 'since': datetime.datetime(2018, 10, 1)}
+            for page_id in range(1, 24)
+        ]
+        with mock.patch('ak_survey_results.boto3.client') as client:
+            client.return_value.send_message_batch.side_effect = [
+                {'Failed': [
+                    {'Id': '3', 'SenderFault': False},
+                    {'Id': '5', 'SenderFault': False}
+                ]},
+                {},
+                {'Failed': [{'Id': '22', 'SenderFault': True}]},
+                {'Failed': [{'Id': '5', 'SenderFault': False}]}
+            ]
+            failed = send_to_queue('surveys-queue', surveys)
+        calls = client.return_value.send_message_batch.call_args_list
+        assert [len(call.kwargs['Entries']) for call in calls] == [
+            10, 10, 3, 2
+        ]
+        assert all(
+            call.kwargs['QueueUrl'] == 'surveys-queue' for call in calls
+        )
+        entries = [
+            entry for call in calls[:3] for entry in call.kwargs['Entries']
+        ]
+        assert [entry['Id'] for entry in entries] == [
+            str(index) for index in range(23)
+        ]
+        assert [json.loads(entry['MessageBody']) for entry in entries] == [
+            {'page_id': page_id, 'since': '2018-10-01T00:00:00'}
+            for page_id in range(1, 24)
+        ]
+        assert calls[3].kwargs['Entries'] == [entries[3], entries[5]]
+        assert failed == [
+            {'Id': '22', 'SenderFault': True},
+            {'Id': '5', 'SenderFault': False}
+        ]
+
+    def test_aws_lambda_with_queue_records(self):
+        from ak_survey_results import aws_lambda
+        response = aws_lambda({'Records': [
+            {
+                'messageId': 'survey-2',
+                'eventSource': 'aws:sqs',
+                'body': json.dumps({
+                    'page_id': 2, 'since': '1900-01-01T00:00:00'
+                })
+            },
+            {
+                'messageId': 'not-json',
+                'eventSource': 'aws:sqs',
+                'body': 'not json'
+            },
+            {'messageId': 'other', 'eventSource': 'aws:sns', 'body': '{}'}
+        ]}, None)
+        assert response == {'batchItemFailures': [
+            {'itemIdentifier': 'not-json'}
+        ]}
+        survey_status = self.survey_results.survey_refresh_info(2)
+        assert survey_status.get('saved_count', False) == 0
+        response = aws_lambda({'Records': [
+            {'messageId': 'other', 'eventSource': 'aws:sns', 'body': '{}'}
+        ]}, None)
+        assert response == {'batchItemFailures': []}
+
+    def test_aws_lambda_with_dropped_connection(self):
+        from ak_survey_results import AKSurveyResults, aws_lambda
+        process = AKSurveyResults.process_recent_actions_for_survey
+
+        def drop_connection(ak, page_id, since):
+            if page_id == 3:
+                terminate_backend(ak.database.get_backend_pid())
+            return process(ak, page_id, since)
+
+        with mock.patch.object(
+            AKSurveyResults, 'process_recent_actions_for_survey',
+            autospec=True, side_effect=drop_connection
+        ):
+            response = aws_lambda({'Records': [
+                {
+                    'messageId': 'survey-%d' % page_id,
+                    'eventSource': 'aws:sqs',
+                    'body': json.dumps({
+                        'page_id': page_id, 'since': '1900-01-01T00:00:00'
+                    })
+                } for page_id in [3, 2]
+            ]}, None)
+        assert response == {'batchItemFailures': [
+            {'itemIdentifier': 'survey-3'}
+        ]}
+        survey_status = self.survey_results.survey_refresh_info(2)
+        assert survey_status.get('saved_count', False) == 0
+
     def teardown_method(self, method):
         drop_survey_schema_query = """
         DROP SCHEMA %s CASCADE
@@ -200,3 +543,4 @@ class Test:
         """ % self.args['DB_SCHEMA_AK']
         self.survey_results.database_cursor.execute(drop_ak_schema_query)
         self.survey_results.database.commit()
+        self.survey_results.close()